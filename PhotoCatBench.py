@@ -0,0 +1,241 @@
+#! /usr/bin/env python
+
+# PhotoCatBench
+#
+# Micro-benchmarks for PhotoCatBot's classification core: needs_update(),
+# guess_locations() and fix_photo_request().
+#
+# Talk pages are generated in memory and template names are resolved
+# from a dict instead of the wiki, so the numbers measure parsing and
+# rule evaluation only, never network I/O.  Each run varies one of:
+#
+#   banners    number of subject/custom WikiProject banners
+#   wpus       number of location params on {{WikiProject United States}}
+#   size       bytes of discussion below the banners
+#   locations  number of location WikiProject banners
+#   request    where {{image requested}} sits: in the header, where only
+#              the header is parsed, or below the first heading, where
+#              the whole page is
+#
+# around a baseline.  It prints ops/sec and the number of objects each
+# call leaves alive for each case, and appends the results to a history
+# file so that runs before and after a change to the rules can be
+# compared.
+
+import argparse
+import datetime
+import gc
+import json
+import os
+import subprocess
+import sys
+import time
+
+import PhotoCatBot as pcb
+
+baseline = {'banners': 3, 'wpus': 2, 'size': 4000, 'locations': 1,
+            'request': 'header'}
+sweeps = {
+    'banners':   [0, 3, 10, 30],
+    'wpus':      [0, 2, 10, len(pcb.WPUS_locations)],
+    'size':      [0, 4000, 64000, 512000],
+    'locations': [0, 1, 5, 20],
+    'request':   ['header', 'section'],
+    }
+
+filler = (u"I think the photo in the infobox could be improved; the one"
+          u" on Commons is much sharper.  [[User:Example|Example]]"
+          u" ([[User talk:Example|talk]]) 12:00, 1 January 2014 (UTC)\n")
+
+
+def make_talk_page(banners, wpus, size, locations, request):
+    """Return the text of a talk page with the given shape.
+
+    'request' is 'header' to put {{image requested}} with the banners,
+    or 'section' to put it at the top of the first section.
+    """
+    banner_names = sorted(pcb.subject_map) + sorted(pcb.custom_map)
+    location_names = sorted(pcb.wikiLocations)
+
+    lines = []
+    for i in range(banners):
+        lines.append(u'{{%s|class=start}}' % banner_names[i % len(banner_names)])
+    for i in range(locations):
+        lines.append(u'{{WikiProject %s}}' % location_names[i % len(location_names)])
+    params = sorted(pcb.WPUS_locations)[:wpus]
+    lines.append(u'{{WikiProject United States%s}}' %
+                 u''.join(u'|%s=yes' % p for p in params))
+    if request == 'header':
+        lines.append(u'{{image requested}}')
+    header = u'\n'.join(lines) + u'\n'
+
+    text = header
+    section = 0
+    while (len(text) - len(header) < size
+           or (request == 'section' and section == 0)):
+        section += 1
+        text += u'\n== Section %d ==\n' % section
+        if section == 1 and request == 'section':
+            text += u'{{image requested}}\n'
+        text += filler * 10
+    return text
+
+
+class MemoryResolver(object):
+    """Resolve template names from memory, as the wiki would without
+    any redirects: just normalise the first letter."""
+
+    def __init__(self):
+        self.names = {}
+
+    def __call__(self, site, template):
+        name = unicode(template.name).strip()
+        if name not in self.names:
+            self.names[name] = u'Template:' + name[:1].upper() + name[1:]
+        return self.names[name]
+
+
+def make_bot(text):
+    bot = pcb.PhotoCatBot(generator=[], resolver=MemoryResolver())
+    bot._article = bot._talk = None
+    bot._article_text = None
+    bot._article_talk = text
+    return bot
+
+
+def measure(setup, op, min_time):
+    """Run op(setup()) repeatedly for at least min_time seconds.
+
+    Returns (ops per second, objects left alive by one op).  Only the
+    time spent in op() is counted.
+
+    Live objects are the growth in objects tracked by the garbage
+    collector across one call, with collection switched off: everything
+    the call built and still refers to afterwards, such as the parse
+    tree.  Temporary objects freed before it returns are not counted,
+    and neither are strings and numbers, which are not tracked.
+    """
+    elapsed = 0.0
+    runs = 0
+    while elapsed < min_time:
+        state = setup()
+        start = time.time()
+        op(state)
+        elapsed += time.time() - start
+        runs += 1
+
+    gc.collect()
+    state = setup()
+    gc.disable()
+    try:
+        before = len(gc.get_objects())
+        op(state)
+        live = len(gc.get_objects()) - before
+    finally:
+        gc.enable()
+    return runs / elapsed, live
+
+
+def bench_case(params, min_time):
+    text = make_talk_page(**params)
+
+    def parsed():
+        bot = make_bot(text)
+        bot.needs_update()
+        return bot
+
+    def guess_all(bot):
+        for t in bot._parsed_text.filter_templates():
+            bot.guess_locations(t)
+
+    return {
+        'needs_update': measure(lambda: make_bot(text),
+                                lambda bot: bot.needs_update(), min_time),
+        'guess_locations': measure(parsed, guess_all, min_time),
+        'fix_photo_request': measure(parsed,
+                                     lambda bot: bot.fix_photo_request(),
+                                     min_time),
+        }
+
+
+def git_revision():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                           stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def previous_results(history):
+    """Return the latest recorded result for each (case, function)."""
+    latest = {}
+    try:
+        with open(history) as f:
+            for line in f:
+                record = json.loads(line)
+                key = (json.dumps(record['params'], sort_keys=True),
+                       record['function'])
+                latest[key] = record
+    except IOError:
+        pass
+    return latest
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--vary',
+                        help='only vary this dimension (default: all of them)',
+                        choices=sorted(sweeps),
+                        action='append')
+    parser.add_argument('--request',
+                        help='where to put {{image requested}} in the cases'
+                             ' that do not vary it (default "header")',
+                        choices=sweeps['request'],
+                        default=baseline['request'])
+    parser.add_argument('--min-time',
+                        help='seconds to spend on each measurement (default 0.5)',
+                        type=float,
+                        default=0.5)
+    parser.add_argument('--history',
+                        help='file to append results to (default "bench_history.jsonl")',
+                        default='bench_history.jsonl')
+    parser.add_argument('--no-record',
+                        help="don't append results to the history file",
+                        action='store_true')
+    args = parser.parse_args(argv[1:])
+
+    previous = previous_results(args.history)
+    now = datetime.datetime.utcnow().isoformat()
+    revision = git_revision()
+    records = []
+
+    print "%-10s %8s  %-18s %12s %10s %8s" % (
+        'vary', 'value', 'function', 'ops/sec', 'live objs', 'change')
+    for dimension in args.vary or sorted(sweeps):
+        for value in sweeps[dimension]:
+            params = dict(baseline, request=args.request)
+            params[dimension] = value
+            results = bench_case(params, args.min_time)
+            for function in sorted(results):
+                rate, live = results[function]
+                key = (json.dumps(params, sort_keys=True), function)
+                change = ''
+                if key in previous:
+                    change = '%+.1f%%' % (
+                        100.0 * (rate / previous[key]['ops_per_sec'] - 1))
+                print "%-10s %8s  %-18s %12.1f %10d %8s" % (
+                    dimension, value, function, rate, live, change)
+                records.append({'time': now, 'revision': revision,
+                                'params': params, 'function': function,
+                                'ops_per_sec': rate,
+                                'live_objects': live})
+
+    if not args.no_record:
+        with open(args.history, 'a') as f:
+            for record in records:
+                f.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -1,7 +1,10 @@
 #! /usr/bin/env python
 
 import argparse
+import collections
+import os
 import re
+import stat
 import sys
 import time
 
@@ -10,6 +13,10 @@ from pywikibot import pagegenerators
 
 import mwparserfromhell
 
+# The modules needed only by --shards, --census and --serve (coordination,
+# ratecontrol, csv and the socket modules) are imported by the functions
+# that run those modes, so that a run on a few named pages starts faster.
+
 # TODO:
 #
 #   * get location hints from other WikiProject templates
@@ -88,25 +95,47 @@ WPUS_locations = {
     'Youngstown':        'Youngstown, Ohio',
     }
 
-# This pattern matches location-oriented WikiProjects.
-wikiLocationPat = re.compile(
-    '(WikiProject|Project|WP)[ _]?'
-    '(Alabama|Alaska|Arizona|Arkansas|California|Colorado|Connecticut'
-    '|Delaware|Florida|Georgia \(U\.S\. state\)|Hawaii|Idaho|Illinois'
-    '|Indiana|Iowa|Kansas|Kentucky|Louisiana|Louisville|Maine|Maryland'
-    '|Mexico|Michigan|Minnesota|Mississippi|Missouri|Montana|Nebraska'
-    '|Nevada|New Hampshire|New Jersey|New Mexico|New York|North Carolina'
-    '|North Dakota|Ohio|Oklahoma|Oregon|Pennsylvania|Rhode Island'
-    '|South Carolina|South Dakota|Tennessee|Texas|Utah|Virginia|Washington'
-    '|West Virginia|Wisconsin|Wyoming'
-    '|Afghanistan|Africa|Argentina|Australia|Bangladesh|Belgium|Bolivia|Bulgaria'
-    '|Cambodia|Canada|Chile|Cornwall|Croatia|Cuba|Cyprus|Devon|Egypt'
-    '|England|Finland|France|Ghana|Greece|Haiti|Hungary|Iceland|India|Indonesia'
-    '|Iraq|Iran|Israel|Italy|Japan|Korea|Kuwait|Lebanon|Lithuania|London'
-    '|Mongolia|Montenegro|New Zealand|Nigeria|Norway|Nottinghamshire|Oman|Ottawa|Pakistan'
-    '|Poland|Portugal|Romania|Russia|Sheffield|Slovakia|Somalia|Spain|Sri Lanka|Surrey'
-    '|Sweden|Syria|Taiwan|Tibet|Turkey|Vancouver|Venezuela|Vietnam|Yorkshire)'
-    r'\s*(\||$)')
+# Location-oriented WikiProjects are named for the place they cover,
+# e.g. {{WikiProject Ohio}} or {{WP Norway}}.  wikiLocationPat splits
+# off the place name, which counts only if it is in wikiLocations.
+# A set lookup keeps this cheap to set up and to match, where one big
+# alternation regex was slow to compile on every startup.
+wikiLocationPat = re.compile(r'(WikiProject|Project|WP)[ _]?(.*?)\s*(\||$)')
+wikiLocations = frozenset([
+    'Alabama', 'Alaska', 'Arizona', 'Arkansas', 'California', 'Colorado',
+    'Connecticut', 'Delaware', 'Florida', 'Georgia (U.S. state)', 'Hawaii',
+    'Idaho', 'Illinois', 'Indiana', 'Iowa', 'Kansas', 'Kentucky', 'Louisiana',
+    'Louisville', 'Maine', 'Maryland', 'Mexico', 'Michigan', 'Minnesota',
+    'Mississippi', 'Missouri', 'Montana', 'Nebraska', 'Nevada',
+    'New Hampshire', 'New Jersey', 'New Mexico', 'New York', 'North Carolina',
+    'North Dakota', 'Ohio', 'Oklahoma', 'Oregon', 'Pennsylvania',
+    'Rhode Island', 'South Carolina', 'South Dakota', 'Tennessee', 'Texas',
+    'Utah', 'Virginia', 'Washington', 'West Virginia', 'Wisconsin', 'Wyoming',
+    'Afghanistan', 'Africa', 'Argentina', 'Australia', 'Bangladesh',
+    'Belgium', 'Bolivia', 'Bulgaria', 'Cambodia', 'Canada', 'Chile',
+    'Cornwall', 'Croatia', 'Cuba', 'Cyprus', 'Devon', 'Egypt', 'England',
+    'Finland', 'France', 'Ghana', 'Greece', 'Haiti', 'Hungary', 'Iceland',
+    'India', 'Indonesia', 'Iraq', 'Iran', 'Israel', 'Italy', 'Japan', 'Korea',
+    'Kuwait', 'Lebanon', 'Lithuania', 'London', 'Mongolia', 'Montenegro',
+    'New Zealand', 'Nigeria', 'Norway', 'Nottinghamshire', 'Oman', 'Ottawa',
+    'Pakistan', 'Poland', 'Portugal', 'Romania', 'Russia', 'Sheffield',
+    'Slovakia', 'Somalia', 'Spain', 'Sri Lanka', 'Surrey', 'Sweden', 'Syria',
+    'Taiwan', 'Tibet', 'Turkey', 'Vancouver', 'Venezuela', 'Vietnam',
+    'Yorkshire',
+    ])
+
+# Matches a section heading.  WikiProject banners and {{image requested}}
+# are almost always placed in the header above the first one.
+headingPat = re.compile(r'^=+[^=\n].*=+[ \t]*$', re.MULTILINE)
+
+# Block markup that a heading-like line inside of it does not end: the
+# header is only cut off when every one of these is closed again.
+blockTags = ('nowiki', 'pre', 'ref', 'source', 'syntaxhighlight', 'math')
+blockOpenPat = re.compile(r'<(%s)\b[^>]*?(/?)>' % '|'.join(blockTags),
+                          re.IGNORECASE)
+blockClosePat = re.compile(r'</(%s)\s*>' % '|'.join(blockTags), re.IGNORECASE)
+tableOpenPat = re.compile(r'^[ \t]*:*[ \t]*\{\|', re.MULTILINE)
+tableClosePat = re.compile(r'^[ \t]*\|\}', re.MULTILINE)
 
 # location_map, subject_map, and custom_map tell PhotoCatBot how to specify
 # photo requests for an article, based on what other WikiProject templates
@@ -336,38 +365,85 @@ custom_map = {
     'WikiProject Wine':                      'needs-photo',
     }
 
+# Canonical template names already looked up, by site and name.
+# The same few hundred banners turn up on nearly every talk page.
+_canonical_names = {}
+
 def canonical_name(site, template):
     """Return the canonical name of this template, after following any redirects."""
-    page = pywikibot.Page(site, 'Template:' + unicode(template.name))
-    while page.isRedirectPage():
-        page = page.getRedirectTarget()
-    return page.title()
-
-def is_photo_request(site, template):
-    return canonical_name(site, template) == 'Template:Image requested'
+    key = (str(site), unicode(template.name).strip())
+    if key not in _canonical_names:
+        page = pywikibot.Page(site, 'Template:' + key[1])
+        while page.isRedirectPage():
+            page = page.getRedirectTarget()
+        _canonical_names[key] = page.title()
+    return _canonical_names[key]
+
+def is_photo_request(site, template, resolver=canonical_name):
+    return resolver(site, template) == 'Template:Image requested'
+
+def split_header(text):
+    """Split talk page text at its first section heading.
+
+    Returns a (header, remainder) tuple, or None when there is no
+    header, or when cutting there would leave a template, table,
+    comment or block tag (such as <ref> or <source>) open in the header.
+    """
+    m = headingPat.search(text)
+    if not m or m.start() == 0:
+        return None
+    header = text[:m.start()]
+    if (header.count('{{') != header.count('}}')
+        or header.count('<!--') != header.count('-->')
+        or len(tableOpenPat.findall(header)) != len(tableClosePat.findall(header))):
+        return None
+    opened = collections.Counter(tag.lower()
+                                 for tag, selfclosing in blockOpenPat.findall(header)
+                                 if not selfclosing)
+    closed = collections.Counter(tag.lower()
+                                 for tag in blockClosePat.findall(header))
+    if opened != closed:
+        return None
+    return header, text[m.start():]
 
 class PhotoCatBot(pywikibot.bot.Bot):
 
-    def __init__(self, debug=False, **kwargs):
+    def __init__(self, debug=False, coordinator=None,
+                 resolver=canonical_name, **kwargs):
         self.debug = debug
+        self.coordinator = coordinator
+        self.resolver = resolver
         super(PhotoCatBot, self).__init__(**kwargs)
 
     def treat(self, page):
-        self._article = (page.toggleTalkPage()
-                         if page.isTalkPage()
-                         else page)
-        self._article_text = None
-        self._article_talk = None
+        if self.coordinator:
+            self.coordinator.heartbeat()
+        self.load(page)
 
         if self.needs_update():
             oldtext = self.article_talk()
             newtext = self.fix_photo_request()
-            self.userPut(self._article.toggleTalkPage(),
+            if self.coordinator:
+                self.coordinator.acquire_edit()
+            self.userPut(self._talk,
                          oldtext,
                          newtext,
                          comment=editComment,
                          botflag=True)
 
+    def load(self, page):
+        """Set 'page' and its talk page (or article) as the ones to work on."""
+        # Keep hold of the talk page object we were given, so that
+        # text already preloaded into it is not fetched a second time.
+        if page.isTalkPage():
+            self._article = page.toggleTalkPage()
+            self._talk = page
+        else:
+            self._article = page
+            self._talk = page.toggleTalkPage()
+        self._article_text = None
+        self._article_talk = None
+
     def article_text(self):
         """Return the text of this article."""
         if not self._article_text:
@@ -377,16 +453,32 @@ class PhotoCatBot(pywikibot.bot.Bot):
     def article_talk(self):
         """Return the (parsed) text of this article's talk page."""
         if not self._article_talk:
-            self._article_talk = self._article.toggleTalkPage().get()
+            self._article_talk = self._talk.get()
         return self._article_talk
 
     def needs_update(self):
         """Returns True if the article's talk page includes any
         {{image requested}} templates that lack any unnamed parameter
-        and lack an 'in' parameter."""
-        self._parsed_text = mwparserfromhell.parse(self.article_talk())
-        for tmpl in self._parsed_text.filter_templates():
-            if (is_photo_request(self._site, tmpl)
+        and lack an 'in' parameter.
+
+        Only the header above the first section heading is parsed when
+        there are no templates below it, so that classify() still sees
+        every banner and request; the rest of the page is kept aside in
+        self._talk_tail and spliced back on by fix_photo_request().
+        Otherwise the whole page is parsed."""
+        text = self.article_talk()
+        split = split_header(text)
+        if split and '{{' not in split[1]:
+            header, self._talk_tail = split
+            self._parsed_text = mwparserfromhell.parse(header)
+            return self._has_bare_request(self._parsed_text)
+        self._talk_tail = ''
+        self._parsed_text = mwparserfromhell.parse(text)
+        return self._has_bare_request(self._parsed_text)
+
+    def _has_bare_request(self, parsed):
+        for tmpl in parsed.filter_templates():
+            if (is_photo_request(self._site, tmpl, self.resolver)
                 and not tmpl.has(1)
                 and not tmpl.has('in')):
                 return True
@@ -397,16 +489,24 @@ class PhotoCatBot(pywikibot.bot.Bot):
         newtext = self.fix_photo_request()
 
 
-    def fix_photo_request(self):
+    def classify(self):
+        """Work out what the parsed talk page says about its photo request.
+
+        Returns a tuple (image_request_tmpl, subjects, locations, banners):
+        the {{image requested}} template, dicts keyed by the subjects and
+        locations it should list, and a list of (template, param) pairs
+        for WikiProject banners that take their own photo request
+        parameter.  Nothing in the page is modified.
+        """
         image_request_tmpl = None
         locations = { }
         subjects = { }
-        changed_banners = False   # set to True when WikiProject banners are updated
+        banners = [ ]
 
         # Find the image request template, so we may easily add to it.
         template_list = self._parsed_text.filter_templates()
         for t in template_list:
-            if is_photo_request(self._site, t):
+            if is_photo_request(self._site, t, self.resolver):
                 image_request_tmpl = t
 
         # visit each template in the text and examine it for clues:
@@ -421,7 +521,7 @@ class PhotoCatBot(pywikibot.bot.Bot):
             # Look up this template in the location map, subject map etc.
             # by its canonical name.
             #
-            template_name = canonical_name(self._site, t)
+            template_name = self.resolver(self._site, t)
             if template_name.startswith('Template:'):
                 template_name = template_name[9:]
 
@@ -432,9 +532,7 @@ class PhotoCatBot(pywikibot.bot.Bot):
             if custom_map.has_key(template_name):
                 # This WikiProject template has its own image request parameter,
                 # which must be set to 'yes'.
-                photo_param = custom_map[template_name]
-                t.add(photo_param, 'yes')
-                changed_banners = True
+                banners.append((t, custom_map[template_name]))
 
         # Remove any redundant locations we may have added.
         # TODO: generalize this.
@@ -465,6 +563,16 @@ class PhotoCatBot(pywikibot.bot.Bot):
                 if locations.has_key(country):
                     del locations[country]
 
+        return image_request_tmpl, subjects, locations, banners
+
+    def fix_photo_request(self):
+        image_request_tmpl, subjects, locations, banners = self.classify()
+
+        # Turn on the photo request parameter of any banners that have one.
+        for t, photo_param in banners:
+            t.add(photo_param, 'yes')
+        changed_banners = bool(banners)
+
         if locations or subjects:
             # Update the image request template with the values from
             # 'subjects' and 'locations'
@@ -496,11 +604,11 @@ class PhotoCatBot(pywikibot.bot.Bot):
             and not image_request_tmpl.has('of'):
             self._parsed_text.remove(image_request_tmpl)
 
-        return unicode(self._parsed_text)
+        return unicode(self._parsed_text) + self._talk_tail
 
     def guess_locations(self, template):
         locations = []
-        template_name = canonical_name(self._site, template)
+        template_name = self.resolver(self._site, template)
 
         if template_name.startswith('Template:'):
             template_name = template_name[9:]
@@ -508,7 +616,7 @@ class PhotoCatBot(pywikibot.bot.Bot):
         # wikiLocationPat has the regional category name embedded
         # in the template name, so we use a special regex for it
         m = wikiLocationPat.match(template_name)
-        if m:
+        if m and m.group(2) in wikiLocations:
             locations.append(m.group(2))
 
         # {{U.S. Roads WikiProject|state=AL|state1=MO|state3=TX|...}}
@@ -541,6 +649,212 @@ class PhotoCatBot(pywikibot.bot.Bot):
             errmsg)
 
 
+class PhotoCensus(PhotoCatBot):
+    """Classify photo requests without editing anything.
+
+    Writes one CSV row per talk page as it goes, and keeps running
+    counts per subject, location and banner, so memory use depends only
+    on how many distinct values there are, not how many pages are read.
+    """
+
+    columns = ['page', 'has_request', 'needs_update',
+               'subjects', 'locations', 'banners']
+
+    def __init__(self, outfile, **kwargs):
+        import csv
+        super(PhotoCensus, self).__init__(**kwargs)
+        self.writer = csv.writer(outfile)
+        self.writer.writerow(self.columns)
+        self.counts = collections.defaultdict(collections.Counter)
+
+    def treat(self, page):
+        if self.coordinator:
+            self.coordinator.heartbeat()
+        self.load(page)
+        self.record(self._talk.title())
+
+    def treat_text(self, title, text):
+        """Classify a talk page whose text we already have, e.g. from a dump."""
+        self._article = self._talk = None
+        self._article_text = None
+        self._article_talk = text
+        self.record(title)
+
+    def record(self, title):
+        needs = self.needs_update()
+        image_request_tmpl, subjects, locations, banners = self.classify()
+        banner_names = sorted(set(unicode(t.name).strip() for t, _ in banners))
+        row = [title,
+               int(image_request_tmpl is not None),
+               int(needs),
+               ';'.join(sorted(subjects)),
+               ';'.join(sorted(locations)),
+               ';'.join(banner_names)]
+        self.writer.writerow([unicode(v).encode('utf-8') for v in row])
+
+        self.counts['total']['pages'] += 1
+        self.counts['total']['has_request'] += row[1]
+        self.counts['total']['needs_update'] += row[2]
+        self.counts['subject'].update(subjects.keys())
+        self.counts['location'].update(locations.keys())
+        self.counts['banner'].update(banner_names)
+
+    def summary(self):
+        """Print the aggregate counts, most common first."""
+        for kind in ('total', 'subject', 'location', 'banner'):
+            for value, count in self.counts[kind].most_common():
+                print u"{}\t{}\t{}".format(count, kind, value).encode('utf-8')
+
+
+def preloaded(args, pagegen):
+    """Return 'pagegen' with the text of its pages preloaded.
+
+    The few pages named on the command line are fetched together by
+    pywikibot's own preloader; only category crawls need ratecontrol.
+    """
+    if args.pages:
+        return pagegenerators.PreloadingGenerator(pagegen)
+    import ratecontrol
+    return ratecontrol.adaptive_preload(pagegen)
+
+
+def run_census(args, make_pagegen):
+    """Run the classifier over a category, page list or XML dump,
+    writing the per-page table to args.census."""
+    with open(args.census, 'wb') as outfile:
+        # Pages from a dump carry no site, and run() is never called to
+        # set one from the generator, so name the site up front.
+        if args.dump:
+            census = PhotoCensus(outfile, site=pywikibot.Site(),
+                                 debug=args.debug)
+        else:
+            census = PhotoCensus(
+                outfile, generator=preloaded(args, make_pagegen()),
+                debug=args.debug)
+        if args.dump:
+            from pywikibot import xmlreader
+            for entry in xmlreader.XmlDump(args.dump).parse():
+                if entry.ns == '1' and entry.text:
+                    census.treat_text(entry.title, entry.text)
+        else:
+            census.run()
+    census.summary()
+
+
+def handle_page_request(rfile, wfile, args):
+    """Treat the page titles sent by one PhotoCatClient connection.
+
+    The client sends one title per line and closes its end; we answer
+    'ok' once every page has been treated, or 'error: ...'.
+    """
+    titles = [line.strip().decode('utf-8')
+              for line in rfile.read().splitlines()
+              if line.strip()]
+    # Start each request with fresh template names, so that
+    # redirects changed on the wiki since the last one are seen.
+    _canonical_names.clear()
+    try:
+        bot = PhotoCatBot(
+            generator=pagegenerators.PagesFromTitlesGenerator(titles),
+            debug=args.debug,
+            always=True)
+        bot.run()
+    except Exception as e:
+        wfile.write(u'error: {}\n'.format(e).encode('utf-8'))
+    else:
+        wfile.write('ok\n')
+
+
+def remove_stale_socket(path):
+    """Remove a socket at 'path' left behind by a daemon that has died.
+
+    Exits if 'path' is anything other than a socket, or if a daemon is
+    still listening on it.
+    """
+    import socket
+    if not os.path.lexists(path):
+        return
+    if not stat.S_ISSOCK(os.lstat(path).st_mode):
+        sys.exit('{} exists and is not a socket'.format(path))
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except socket.error:
+        os.unlink(path)
+    else:
+        sys.exit('another daemon is already listening on {}'.format(path))
+    finally:
+        probe.close()
+
+
+def serve(args):
+    """Stay running and treat pages sent over a Unix socket.
+
+    Startup costs (importing pywikibot, building the site object and
+    logging in) are paid once here, so each PhotoCatClient call only
+    costs the fetches and edits for its own pages.
+    """
+    import SocketServer
+
+    class PageRequestHandler(SocketServer.StreamRequestHandler):
+        def handle(self):
+            handle_page_request(self.rfile, self.wfile, args)
+
+    remove_stale_socket(args.serve)
+    server = SocketServer.UnixStreamServer(args.serve, PageRequestHandler)
+    print "{}: listening on {}".format(time.asctime(), args.serve)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(args.serve)
+
+
+def run_sharded(args, make_pagegen):
+    """Work through shards of the crawl until every one is done.
+
+    Every worker walks the full page list but only treats the pages
+    in the shard it holds.  When no shard is free, the worker waits for
+    the earliest lease held by another worker to expire, so the shard
+    of a worker that crashed is taken over.
+
+    Returns False if the bot was stopped part way through a shard (by
+    Ctrl-C or by quitting at a prompt), and True once the run is done.
+    """
+    import coordination
+    run = args.run or args.category
+    edits_per_minute = (args.edits_per_minute
+                        or coordination.defaultEditsPerMinute)
+    coord = coordination.Coordinator(args.coord, args.shards, run,
+                                     edits_per_minute=edits_per_minute)
+    while True:
+        shard = coord.claim()
+        if shard is None:
+            expires = coord.next_expiry()
+            if expires is None:
+                return True
+            time.sleep(max(expires - time.time(), 1))
+            continue
+        print "{}: working on shard {}/{} of {} generation {}".format(
+            time.asctime(), shard, args.shards, run, coord.generation)
+        pagegen = coord.shard_pages(make_pagegen())
+        bot = PhotoCatBot(generator=preloaded(args, pagegen),
+                          coordinator=coord,
+                          debug=args.debug,
+                          always=args.always)
+        try:
+            bot.run()
+        except coordination.LeaseLost:
+            print "{}: lost lease on shard {}".format(time.asctime(), shard)
+            continue
+        # run() returns normally when the user stops it; leave the lease
+        # to expire so the rest of the shard is crawled by someone else.
+        if not bot._generator_completed:
+            print "{}: stopped in shard {}".format(time.asctime(), shard)
+            return False
+        coord.finish()
+
+
 def main(argv):
     parser = argparse.ArgumentParser()
     parser.add_argument('--debug', '-d',
@@ -557,26 +871,70 @@ def main(argv):
     parser.add_argument('--always',
                         help='always save changes without prompting',
                         action='store_true')
+    parser.add_argument('--shards',
+                        help='split the crawl into this many shards, shared'
+                             ' with other workers through --coord',
+                        type=int)
+    parser.add_argument('--coord',
+                        help='shared coordination database for --shards'
+                             ' (default "photocatbot.db")',
+                        default='photocatbot.db')
+    parser.add_argument('--run',
+                        help='name shared by all workers on the same crawl'
+                             ' (default: the category name)')
+    parser.add_argument('--edits-per-minute',
+                        help='edit budget shared by all workers (default 10)',
+                        type=int)
+    parser.add_argument('--census',
+                        help='write a table classifying every page to this'
+                             ' CSV file, without editing anything')
+    parser.add_argument('--dump',
+                        help='with --census, read talk pages from this XML'
+                             ' dump instead of the wiki')
+    parser.add_argument('--serve',
+                        metavar='SOCKET',
+                        help='run as a daemon, treating page titles sent to'
+                             ' this Unix socket by PhotoCatClient.py'
+                             ' (requires --always)')
     parser.add_argument('pages',
                         help='List of page titles to process',
                         nargs=argparse.REMAINDER)
 
     args = parser.parse_args(argv[1:])
-    site = pywikibot.Site()
-
-    while True:
-        # Select an appropriate page generator based on the --category
-        # argument and/or positional 'page' arguments
+    if args.serve and not args.always:
+        parser.error('--serve cannot prompt for changes; use --always')
+
+    # Select an appropriate page generator based on the --category
+    # argument and/or positional 'page' arguments.
+    #
+    # Articles are swapped for their talk pages, which are the pages
+    # the bot reads and edits, so that those are what gets preloaded.
+    def make_pagegen():
         if args.pages:
             pagegen = pagegenerators.PagesFromTitlesGenerator(args.pages)
         else:
-            cat = pywikibot.Category(site, 'Category:' + args.category)
+            cat = pywikibot.Category(pywikibot.Site(), 'Category:' + args.category)
             pagegen = pagegenerators.CategorizedPageGenerator(cat)
+        return pagegenerators.PageWithTalkPageGenerator(pagegen,
+                                                        return_talk_only=True)
 
-        bot = PhotoCatBot(generator=pagegen,
-                          debug=args.debug,
-                          always=args.always)
-        bot.run()
+    if args.serve:
+        serve(args)
+        return
+
+    if args.census:
+        run_census(args, make_pagegen)
+        return
+
+    while True:
+        if args.shards:
+            if not run_sharded(args, make_pagegen):
+                break
+        else:
+            bot = PhotoCatBot(generator=preloaded(args, make_pagegen()),
+                              debug=args.debug,
+                              always=args.always)
+            bot.run()
 
         if args.repeat:
             nextrun = args.repeat * 60
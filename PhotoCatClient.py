@@ -0,0 +1,49 @@
+#! /usr/bin/env python
+
+# PhotoCatClient
+#
+# Hand page titles to a PhotoCatBot running as a daemon:
+#
+#   PhotoCatBot.py --serve photocatbot.sock --always
+#   PhotoCatClient.py Page1 Page2
+#
+# This script imports nothing but the standard library, so that hooks
+# calling it do not pay for loading pywikibot on every invocation.
+
+import argparse
+import socket
+import sys
+
+defaultSocket = 'photocatbot.sock'
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--socket', '-s',
+                        help='socket the daemon listens on (default "{}")'.format(
+                            defaultSocket),
+                        default=defaultSocket)
+    parser.add_argument('pages',
+                        help='List of page titles to process',
+                        nargs='+')
+    args = parser.parse_args(argv[1:])
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(args.socket)
+    sock.sendall('\n'.join(args.pages) + '\n')
+    sock.shutdown(socket.SHUT_WR)
+
+    reply = ''
+    while True:
+        data = sock.recv(4096)
+        if not data:
+            break
+        reply += data
+    sock.close()
+
+    sys.stdout.write(reply)
+    return 0 if reply.startswith('ok') else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -14,13 +14,16 @@
 
 import argparse
 import os
+import Queue
 import re
 import sys
 import time
+from multiprocessing.pool import ThreadPool
 
 import county_map
 import mwparserfromhell as mw
 import pywikibot
+import ratecontrol
 from pywikibot import pagegenerators
 
 # These strings are used to find a starting category to crawl
@@ -31,9 +34,8 @@ startCat = 'Category:Wikipedia requested photographs in %s'
 
 debug = False
 
-def guess_county(text, state):
-    cm = county_map.county_map()
-
+def intro_links(text):
+    """Return the targets of the links in the first paragraph of 'text'."""
     # find the first paragraph in the text (skipping grafs that are
     # just templates or images)
     while re.match('\s*({{[^}]}}|\[\[[^]]?\]\])\n\s*', text, re.DOTALL):
@@ -42,18 +44,24 @@ def guess_county(text, state):
     try:
         intro = grafs[0]
     except IndexError:
-        return None
+        return []
 
-    links = re.findall(r'\[\[(.*?)\]\]', intro)
+    return [link.split('|')[0]
+            for link in re.findall(r'\[\[(.*?)\]\]', intro)]
+
+def guess_county(text, state, lookups=None):
+    if lookups is not None:
+        link_county = lookups.link_county
+    else:
+        link_county = county_map.county_map().lookup
 
     # look for [[Foo, Bar]] links and see if any of them are recognized towns
-    for link in links:
-        exactlink = link.split('|')[0]
+    for exactlink in intro_links(text):
         county = find_county_in_text(exactlink, state)
         if county:
             log("guess_county: found '{}' in link [[{}]]".format(county, exactlink))
             return county
-        county = cm.lookup(exactlink)
+        county = link_county(exactlink)
         if county:
             log("guess_county: found '{}' from looking up link [[{}]]".format(county, exactlink))
             return county
@@ -75,8 +83,12 @@ def lookup_county(town):
         townpage = pywikibot.Page(pywikibot.Site(), town).get()
     except pywikibot.NoPage():
         return None
+    return county_from_infobox(townpage)
 
-    w = mw.parse(townpage)
+def county_from_infobox(text):
+    """Return the county named in the {{Infobox settlement}} of
+    article text 'text', or None if there is none."""
+    w = mw.parse(text)
     for t in w.filter_templates():
         if t.name.strip_code() == 'Infobox settlement':
             # Find the subdivision_name parameters and
@@ -95,18 +107,55 @@ def find_county_in_text(text, state):
         return m.group(1)
     return False
 
-def maybe_create_category(county, state):
+def create_category(county, state):
+    """Create the photo request category for 'county'.
+
+    Uses createonly, so that a category someone else created since the
+    CategoryIndex was loaded is left alone; that counts as success too.
+    """
     cat = 'Category:Wikipedia requested photographs in %s' % county
     catpage = pywikibot.Page(pywikibot.Site(), cat)
     try:
-        text = catpage.get()
-    except pywikibot.NoPage:
         catpage.put("""{{US image sources}}
 {{howtoreqphotoin|%s}}
 <br clear=all />
 
-[[Category:Wikipedia requested photographs in %s|%s]]""" % (county, state, county))
-        print 'created category [[%s]]' % cat
+[[Category:Wikipedia requested photographs in %s|%s]]""" % (county, state, county),
+                    createonly=True)
+    except pywikibot.PageCreatedConflict:
+        print 'category [[%s]] already exists' % cat
+        return
+    print 'created category [[%s]]' % cat
+
+class CategoryIndex(object):
+    """The set of existing 'Wikipedia requested photographs in ...'
+    categories, loaded with a single prefix listing.
+
+    Counties without a category are queued with request() and
+    created together by create_pending() at the end of the run,
+    instead of checking each category page as articles are moved.
+    """
+    prefix = 'Wikipedia requested photographs in '
+
+    def __init__(self, site):
+        self.existing = set(
+            p.title(withNamespace=False)
+            for p in site.allpages(prefix=self.prefix, namespace=14))
+        self.pending = {}
+
+    def request(self, county, state):
+        if self.prefix + county not in self.existing:
+            self.pending.setdefault(county, state)
+
+    def create_pending(self):
+        for county in sorted(self.pending):
+            try:
+                create_category(county, self.pending[county])
+            except pywikibot.Error as e:
+                print 'could not create category for %s: %s' % (county, e)
+                continue
+            self.existing.add(self.prefix + county)
+        self.pending = {}
 
 def log(msg):
     if debug:
@@ -131,23 +180,170 @@ def is_photo_request(node):
     return False
 
 
+class Lookups(object):
+    """The network lookups treat() needs for one article.
+
+    Results prefetched by a CountyLookupEngine are used when there are
+    any; anything else is looked up when it is asked for.
+    """
+
+    def __init__(self, article, talk, results=None):
+        self.article = article
+        self.talk = talk
+        self.results = results or {}
+        self._county_map = None
+        self._infobox_checked = False
+        self._infobox = None
+
+    def _get(self, key, func, *args):
+        result = self.results.get(key)
+        if result is not None:
+            return result.get()
+        return func(*args)
+
+    def article_text(self):
+        return self._get('article', self.article.get)
+
+    def talk_text(self):
+        return self._get('talk', self.talk.get)
+
+    def infobox_county(self):
+        if not self._infobox_checked:
+            self._infobox = county_from_infobox(self.article_text())
+            self._infobox_checked = True
+        return self._infobox
+
+    def link_county(self, link):
+        return self._get(('link', link), self._lookup_link, link)
+
+    def _lookup_link(self, link):
+        if self._county_map is None:
+            self._county_map = county_map.county_map()
+        return self._county_map.lookup(link)
+
+
+class CountyLookupEngine(object):
+    """Prefetch the lookups for many articles at once.
+
+    The generator should yield pages whose text is already loaded, as
+    adaptive_preload() does.  Up to 'window' of them are in progress at
+    a time.  For each one, the other page of the pair (the article for
+    a talk page, or the talk page for an article) is fetched.  For
+    articles where neither the infobox nor the title names a county, the
+    towns linked from the intro are then looked up concurrently as well,
+    up to the first link that names its county outright, since
+    guess_county() never looks further than that.  Each page is yielded
+    as soon as its own lookups are under way.
+
+    Every request goes through 'controller', the same AIMDController
+    that paces the preloading, and shares its concurrency slots, so
+    maxlag and slow responses throttle these reads too.  The threads
+    share pywikibot's pooled HTTP session.
+
+    treat() still makes its decisions in the same order as before;
+    only the waiting is overlapped.
+    """
+
+    def __init__(self, state, controller, window=20):
+        self.state = state
+        self.controller = controller
+        self.window = window
+        self.pool = ThreadPool(controller.max_concurrency)
+        # Works out which links each page needs, waiting on its first
+        # lookups; kept apart from self.pool so it never blocks a fetch.
+        self.planner = ThreadPool(window)
+        self.county_map = county_map.county_map()
+        self.lookups = {}
+
+    def _fetch(self, func, *args):
+        return self.pool.apply_async(self.controller.call, (func, args))
+
+    def _links_to_lookup(self, lookups):
+        try:
+            if lookups.infobox_county():
+                return []
+            if find_county_in_text(lookups.talk.title(), self.state):
+                return []
+            text = lookups.article_text()
+        except KeyboardInterrupt:
+            raise
+        except:
+            # treat() reports the error when it asks for the result.
+            return []
+        links = []
+        for link in intro_links(text):
+            if find_county_in_text(link, self.state):
+                break
+            links.append(link)
+        return links
+
+    def _plan(self, page, lookups, ready):
+        try:
+            for link in self._links_to_lookup(lookups):
+                lookups.results[('link', link)] = self._fetch(
+                    self.county_map.lookup, link)
+        finally:
+            ready.put((page, lookups))
+
+    def prefetch(self, generator):
+        """Yield the pages from 'generator' as their lookups get under way."""
+        generator = iter(generator)
+        ready = Queue.Queue()
+        in_flight = 0
+        exhausted = False
+        while True:
+            while not exhausted and in_flight < self.window:
+                try:
+                    page = next(generator)
+                except StopIteration:
+                    exhausted = True
+                    break
+                # 'page' itself is already loaded, so reading it again
+                # is neither prefetched nor counted by the controller.
+                if page.isTalkPage():
+                    article, talk = page.toggleTalkPage(), page
+                    results = {'article': self._fetch(article.get)}
+                else:
+                    article, talk = page, page.toggleTalkPage()
+                    results = {'talk': self._fetch(talk.get)}
+                lookups = Lookups(article, talk, results)
+                self.planner.apply_async(self._plan, (page, lookups, ready))
+                in_flight += 1
+            if not in_flight:
+                break
+            in_flight -= 1
+            # Only hand over lookups that are done planning, so that
+            # treat() and _plan() never wait on the same result.
+            page, lookups = ready.get()
+            self.lookups[page.title()] = lookups
+            yield page
+
+    def take(self, page):
+        """Return the Lookups for 'page', removing them from the engine."""
+        return self.lookups.pop(page.title(), None)
+
+
 class PhotoCountyBot(pywikibot.bot.Bot):
-    def __init__(self, state, **kwargs):
+    def __init__(self, state, categories=None, engine=None, **kwargs):
         self.state = state
+        self.categories = categories
+        self.engine = engine
         super(PhotoCountyBot, self).__init__(**kwargs)
 
     def treat(self, page):
         global debug
 
-        if page.isTalkPage():
-            article = page.toggleTalkPage()
-            talk = page
-        else:
-            article = page
-            talk = page.toggleTalkPage()
+        lookups = self.engine.take(page) if self.engine else None
+        if lookups is None:
+            if page.isTalkPage():
+                lookups = Lookups(page.toggleTalkPage(), page)
+            else:
+                lookups = Lookups(page, page.toggleTalkPage())
+        article = lookups.article
+        talk = lookups.talk
 
         try:
-            text = article.get()
+            text = lookups.article_text()
         except KeyboardInterrupt:
             raise
         except:
@@ -163,11 +359,11 @@ class PhotoCountyBot(pywikibot.bot.Bot):
 
         # cm = county_map.county_map()
         # county = cm.lookup(article.title())
-        county = lookup_county(article.title())
+        county = lookups.infobox_county()
         if not county:
             county = find_county_in_text(page.title(), self.state)
         if not county:
-            county = guess_county(text, self.state)
+            county = guess_county(text, self.state, lookups)
 
         if not county:
             print "couldn't guess at %s" % page.title()
@@ -175,7 +371,7 @@ class PhotoCountyBot(pywikibot.bot.Bot):
 
         # Find an {{image requested}} template and update it with
         # the desired location.
-        oldtext = talk.get()
+        oldtext = lookups.talk_text()
         parsed = mw.parse(oldtext)
         tmpls = parsed.filter_templates(matches=is_photo_request)
         if tmpls:
@@ -198,12 +394,14 @@ class PhotoCountyBot(pywikibot.bot.Bot):
 
         log(page.title())
         try:
-            self.userPut(
+            saved = self.userPut(
                 page, oldtext, newtext, botflag=True,
                 comment='moving to [[Category:Wikipedia requested photographs in %s]] by the [[User:PhotoCatBot|PhotoCat]]' % county)
-            #maybe_create_category(county, self.state, self.site)
         except pywikibot.LockedPage:
             return False
+        # Only ask for a category if an article was actually moved into it.
+        if saved and self.categories is not None:
+            self.categories.request(county, self.state)
 
 
 def main(argv):
@@ -220,6 +418,14 @@ def main(argv):
     parser.add_argument('--place', '-p', '--location', '-l',
                         help='specify location to start (required)',
                         required=True)
+    parser.add_argument('--connections',
+                        help='most reads from the wiki to run at once; fewer are'
+                             ' used while the servers are slow (default 8)',
+                        type=int,
+                        default=8)
+    parser.add_argument('--create-categories',
+                        help='create any missing county categories at the end of the run',
+                        action='store_true')
 
     args = parser.parse_args(argv[1:])
     debug = args.debug
@@ -227,9 +433,19 @@ def main(argv):
 
     site = pywikibot.Site()
     cat = pywikibot.Category(site, startCat)
-    gen = pagegenerators.CategorizedPageGenerator(cat)
-    bot = PhotoCountyBot(state=args.place, generator=gen)
-    bot.run()
+    controller = ratecontrol.AIMDController(max_concurrency=args.connections)
+    ratecontrol.watch_lag(site.throttle, controller)
+    gen = ratecontrol.adaptive_preload(
+        pagegenerators.CategorizedPageGenerator(cat), controller)
+    engine = CountyLookupEngine(args.place, controller)
+    categories = CategoryIndex(site) if args.create_categories else None
+    bot = PhotoCountyBot(state=args.place, categories=categories,
+                         engine=engine, generator=engine.prefetch(gen))
+    try:
+        bot.run()
+    finally:
+        if categories is not None:
+            categories.create_pending()
 
 
 if __name__ == '__main__':
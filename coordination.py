@@ -0,0 +1,226 @@
+# coordination
+#
+# Lets several PhotoCatBot workers, on one host or several sharing a
+# filesystem, split a crawl between them.
+#
+# The page space is divided into a fixed number of shards by page ID.
+# A worker claims a shard by taking out a lease on it in a shared sqlite
+# database, and keeps the lease alive with heartbeats while it works.
+# If a worker dies, its lease expires and the shard is picked up by one
+# of the workers still waiting for the run to finish.
+#
+# Each pass over the crawl is a numbered generation of its run.  Workers
+# join the latest generation that is not yet finished, and start a new
+# one (clearing out the old leases) only once every shard is done, so
+# workers started at different times still end up sharing the work.
+#
+# The same database holds a log of recent edits, so that all workers
+# together stay within a single edit-rate budget.
+
+import os
+import socket
+import sqlite3
+import time
+import zlib
+
+defaultLeaseSeconds = 300
+defaultEditsPerMinute = 10
+
+
+def shard_of(page, shards):
+    """Return the shard number (0 .. shards-1) for a pywikibot Page.
+
+    Uses the page ID when the page generator has already supplied one,
+    and falls back to a CRC of the title, so that the answer is the
+    same in every worker and never costs an extra API request.
+    """
+    pageid = getattr(page, '_pageid', None)
+    if pageid:
+        return int(pageid) % shards
+    title = page.title().encode('utf-8')
+    return (zlib.crc32(title) & 0xffffffff) % shards
+
+
+class LeaseLost(Exception):
+    """Raised when another worker has taken over a shard we were working on."""
+
+
+class Coordinator(object):
+
+    def __init__(self, path, shards, run,
+                 lease_seconds=defaultLeaseSeconds,
+                 edits_per_minute=defaultEditsPerMinute,
+                 worker=None):
+        self.path = path
+        self.shards = shards
+        self.run = run
+        self.shard = None
+        self.lease_seconds = lease_seconds
+        self.edits_per_minute = edits_per_minute
+        self.worker = worker or '{}:{}'.format(socket.gethostname(), os.getpid())
+        self._last_heartbeat = 0
+
+        self._db = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS runs (
+                              run TEXT PRIMARY KEY, generation INTEGER)""")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS leases (
+                              run TEXT, generation INTEGER, shard INTEGER,
+                              owner TEXT, expires REAL,
+                              done INTEGER DEFAULT 0,
+                              PRIMARY KEY (run, generation, shard))""")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS edits (
+                              ts REAL, owner TEXT)""")
+        self.generation = self._join()
+
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the database write lock up front, so
+        # two workers can never both decide the same shard is free.
+        self._db.execute('BEGIN IMMEDIATE')
+
+    def _join(self):
+        """Return the generation of this run to work on.
+
+        That is the latest one, unless all of its shards are done, in
+        which case a new generation is started and the leases of the
+        old ones are deleted.
+        """
+        self._transaction()
+        try:
+            row = self._db.execute('SELECT generation FROM runs WHERE run = ?',
+                                   (self.run,)).fetchone()
+            if row is None:
+                generation = 0
+                self._db.execute('INSERT INTO runs (run, generation) VALUES (?, ?)',
+                                 (self.run, generation))
+            else:
+                generation = row[0]
+                done = self._db.execute(
+                    'SELECT COUNT(*) FROM leases'
+                    ' WHERE run = ? AND generation = ? AND done = 1',
+                    (self.run, generation)).fetchone()[0]
+                if done >= self.shards:
+                    generation += 1
+                    self._db.execute('UPDATE runs SET generation = ? WHERE run = ?',
+                                     (generation, self.run))
+                    self._db.execute('DELETE FROM leases WHERE run = ? AND generation < ?',
+                                     (self.run, generation))
+            self._db.execute('COMMIT')
+            return generation
+        except:
+            self._db.execute('ROLLBACK')
+            raise
+
+    def claim(self):
+        """Claim a shard that is unowned or whose lease has expired.
+
+        Returns the shard number, or None if every shard in this
+        generation is either finished or held by a live worker.
+        """
+        now = time.time()
+        self._transaction()
+        try:
+            rows = self._db.execute(
+                'SELECT shard, owner, expires, done FROM leases'
+                ' WHERE run = ? AND generation = ?',
+                (self.run, self.generation)).fetchall()
+            known = dict((r[0], r) for r in rows)
+            for shard in range(self.shards):
+                row = known.get(shard)
+                if row is None:
+                    self._db.execute(
+                        'INSERT INTO leases (run, generation, shard, owner, expires)'
+                        ' VALUES (?, ?, ?, ?, ?)',
+                        (self.run, self.generation, shard, self.worker,
+                         now + self.lease_seconds))
+                elif not row[3] and row[2] < now:
+                    self._db.execute(
+                        'UPDATE leases SET owner = ?, expires = ?'
+                        ' WHERE run = ? AND generation = ? AND shard = ?',
+                        (self.worker, now + self.lease_seconds,
+                         self.run, self.generation, shard))
+                else:
+                    continue
+                self._db.execute('COMMIT')
+                self._last_heartbeat = now
+                self.shard = shard
+                return shard
+            self._db.execute('COMMIT')
+            return None
+        except:
+            self._db.execute('ROLLBACK')
+            raise
+
+    def next_expiry(self):
+        """Return when the earliest unfinished lease held by another worker
+        expires, or None if every shard in this generation is done."""
+        return self._db.execute(
+            'SELECT MIN(expires) FROM leases'
+            ' WHERE run = ? AND generation = ? AND done = 0',
+            (self.run, self.generation)).fetchone()[0]
+
+    def heartbeat(self, force=False):
+        """Extend our lease on the shard we hold.
+
+        Only touches the database once a third of the lease period has
+        passed, so it is cheap to call for every page.  Raises LeaseLost
+        if the lease has been reclaimed by another worker.
+        """
+        if self.shard is None:
+            return
+        now = time.time()
+        if not force and now - self._last_heartbeat < self.lease_seconds / 3.0:
+            return
+        cur = self._db.execute(
+            'UPDATE leases SET expires = ?'
+            ' WHERE run = ? AND generation = ? AND shard = ?'
+            ' AND owner = ? AND done = 0',
+            (now + self.lease_seconds, self.run, self.generation,
+             self.shard, self.worker))
+        if cur.rowcount != 1:
+            shard, self.shard = self.shard, None
+            raise LeaseLost(shard)
+        self._last_heartbeat = now
+
+    def finish(self):
+        """Mark the shard we hold as finished."""
+        self._db.execute(
+            'UPDATE leases SET done = 1'
+            ' WHERE run = ? AND generation = ? AND shard = ? AND owner = ?',
+            (self.run, self.generation, self.shard, self.worker))
+        self.shard = None
+
+    def shard_pages(self, generator):
+        """Filter a page generator down to the pages in the shard we hold.
+
+        Pages may be read from this well ahead of being treated (by a
+        preloader, say), so the bot heartbeats as it treats each page
+        rather than as pages are read from here.
+        """
+        shard = self.shard
+        for page in generator:
+            if shard_of(page, self.shards) == shard:
+                yield page
+
+    def acquire_edit(self):
+        """Block until the shared edit budget allows one more edit,
+        then record it."""
+        while True:
+            now = time.time()
+            self._transaction()
+            try:
+                self._db.execute('DELETE FROM edits WHERE ts < ?', (now - 60,))
+                count, oldest = self._db.execute(
+                    'SELECT COUNT(*), MIN(ts) FROM edits').fetchone()
+                if count < self.edits_per_minute:
+                    self._db.execute('INSERT INTO edits (ts, owner) VALUES (?, ?)',
+                                     (now, self.worker))
+                    self._db.execute('COMMIT')
+                    return
+                self._db.execute('COMMIT')
+            except:
+                self._db.execute('ROLLBACK')
+                raise
+            # Keep our lease alive while we wait for the budget.
+            self.heartbeat()
+            time.sleep(min(max(oldest + 60 - now, 0.5),
+                           self.lease_seconds / 3.0))
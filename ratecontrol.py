@@ -0,0 +1,224 @@
+# ratecontrol
+#
+# Adaptive control of how hard the bots read from the wiki.
+#
+# Page fetches are grouped into batches, and several batches may be in
+# flight at once.  AIMDController decides how big the batches are and
+# how many run concurrently: both grow additively while responses come
+# back quickly, and are cut multiplicatively when responses slow down or
+# the servers report replication lag.  This is the same scheme TCP uses
+# for its congestion window.
+#
+# Only reads are governed here.  Edits keep going through pywikibot's
+# fixed put throttle (and the shared budget in coordination.py), so a
+# burst of fast reads never turns into a burst of edits.
+
+import collections
+import functools
+import itertools
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+# How many times one batch is retried after the servers report lag,
+# on top of pywikibot's own retries, before the run gives up.
+defaultMaxRetries = 5
+
+
+class Lagged(Exception):
+    """Raised by a fetch function when the servers ask us to back off."""
+
+    def __init__(self, retry_after=None):
+        super(Lagged, self).__init__(retry_after)
+        self.retry_after = retry_after
+
+
+class AIMDController(object):
+
+    def __init__(self,
+                 min_concurrency=1, max_concurrency=4,
+                 min_batch=10, max_batch=250,
+                 target_latency=2.0,
+                 increase=1.0, decrease=0.5,
+                 default_retry_after=5.0,
+                 clock=time.time, sleep=time.sleep):
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.min_batch = min_batch
+        self.max_batch = max_batch
+        self.target_latency = target_latency
+        self.increase = increase
+        self.decrease = decrease
+        self.default_retry_after = default_retry_after
+        self.clock = clock
+        self.sleep = sleep
+
+        self._concurrency = float(min_concurrency)
+        self._batch = float(min_batch)
+        self._hold_until = 0
+        self._lock = threading.Lock()
+        self._slots = threading.Condition()
+        self._in_flight = 0
+
+    @property
+    def concurrency(self):
+        return int(self._concurrency)
+
+    @property
+    def batch_size(self):
+        return int(self._batch)
+
+    def _clamp(self):
+        self._concurrency = min(max(self._concurrency, self.min_concurrency),
+                                self.max_concurrency)
+        self._batch = min(max(self._batch, self.min_batch), self.max_batch)
+
+    def _back_off(self):
+        self._concurrency *= self.decrease
+        self._batch *= self.decrease
+        self._clamp()
+
+    def on_response(self, latency, pages=1):
+        """Record a completed fetch of 'pages' pages that took 'latency' seconds."""
+        with self._lock:
+            # Judge latency per page-equivalent of a minimum batch, so
+            # that growing the batch does not by itself look like lag.
+            scaled = latency * self.min_batch / max(pages, self.min_batch)
+            if scaled > self.target_latency:
+                self._back_off()
+            else:
+                # One full step per round of 'concurrency' responses.
+                self._concurrency += self.increase / self._concurrency
+                self._batch += self.increase * self.min_batch / self._concurrency
+                self._clamp()
+
+    def on_lag(self, retry_after=None):
+        """Record a maxlag or Retry-After response from the server."""
+        with self._lock:
+            self._back_off()
+            if retry_after is None:
+                retry_after = self.default_retry_after
+            self._hold_until = max(self._hold_until, self.clock() + retry_after)
+
+    def wait(self):
+        """Sleep until any back-off requested by the server has passed."""
+        delay = self._hold_until - self.clock()
+        if delay > 0:
+            self.sleep(delay)
+
+    def call(self, func, args=(), pages=1):
+        """Make one request, func(*args), for 'pages' pages.
+
+        Waits until fewer than 'concurrency' calls are in flight and any
+        back-off has passed, then records how long the call took.  A
+        Lagged exception is recorded and re-raised.
+        """
+        with self._slots:
+            while self._in_flight >= self.concurrency:
+                self._slots.wait()
+            self._in_flight += 1
+        try:
+            self.wait()
+            start = self.clock()
+            try:
+                result = func(*args)
+            except Lagged as e:
+                self.on_lag(e.retry_after)
+                raise
+            self.on_response(self.clock() - start, pages)
+            return result
+        finally:
+            with self._slots:
+                self._in_flight -= 1
+                self._slots.notify_all()
+
+
+def watch_lag(throttle, controller):
+    """Tell 'controller' whenever pywikibot pauses for server lag.
+
+    pywikibot handles maxlag errors and Retry-After headers inside its
+    API layer: it stores the Retry-After value on the site throttle and
+    calls throttle.lag() before retrying.  Wrapping lag() lets the
+    controller back off every reader, not just the one that was told.
+    """
+    if getattr(throttle, '_lag_controller', None) is None:
+        lag = throttle.lag
+
+        def lag_watcher(lagtime=None):
+            throttle._lag_controller.on_lag(throttle.retry_after or lagtime)
+            return lag(lagtime)
+
+        throttle.lag = lag_watcher
+    throttle._lag_controller = controller
+
+
+def preload_batch(pages, controller=None):
+    """Fetch the text of 'pages' in a single API request.
+
+    Lag reported while pywikibot retries the request is passed on to
+    'controller'.  If pywikibot gives up retrying (MaxlagTimeoutError
+    and other TimeoutErrors), Lagged is raised so the batch is retried
+    once the controller's back-off has passed.
+    """
+    import pywikibot
+    site = pages[0].site
+    if controller is not None:
+        watch_lag(site.throttle, controller)
+    try:
+        return list(site.preloadpages(pages, groupsize=len(pages)))
+    except pywikibot.exceptions.TimeoutError:
+        raise Lagged(site.throttle.retry_after or None)
+
+
+def adaptive_preload(generator, controller=None, fetch=None,
+                     max_retries=defaultMaxRetries):
+    """Yield pages from 'generator' with their text already loaded.
+
+    Pages are fetched in batches sized by the controller.  While the
+    pages of one batch are being yielded, up to controller.concurrency
+    further batches are in flight, topped up as each batch is taken.
+    Each fetch takes one of the controller's slots, like any other
+    controller.call(), so other readers sharing the controller count
+    against the same limit.
+    Batches are yielded in the order the generator produced them.
+
+    'fetch' takes a list of pages and returns them loaded; it may raise
+    Lagged.  By default it is preload_batch().  A batch is retried after
+    each Lagged, but after 'max_retries' retries Lagged is raised to the
+    caller, so a wiki that stays down stops the run.
+    """
+    if controller is None:
+        controller = AIMDController()
+    if fetch is None:
+        fetch = functools.partial(preload_batch, controller=controller)
+    pool = ThreadPool(controller.max_concurrency)
+
+    def timed_fetch(batch):
+        for retry in itertools.count():
+            try:
+                return controller.call(fetch, (batch,), len(batch))
+            except Lagged:
+                if retry >= max_retries:
+                    raise
+
+    generator = iter(generator)
+    pending = collections.deque()
+    exhausted = False
+    try:
+        while True:
+            if pending:
+                pages = pending.popleft().get()
+            else:
+                pages = []
+            while not exhausted and len(pending) < controller.concurrency:
+                batch = list(itertools.islice(generator, controller.batch_size))
+                if not batch:
+                    exhausted = True
+                    break
+                pending.append(pool.apply_async(timed_fetch, (batch,)))
+            for page in pages:
+                yield page
+            if not pending:
+                break
+    finally:
+        pool.terminate()
@@ -0,0 +1,64 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import coordination
+
+
+class CoordinatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'coord.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def worker(self, name, lease_seconds=300):
+        return coordination.Coordinator(self.path, 2, 'test',
+                                        lease_seconds=lease_seconds,
+                                        worker=name)
+
+    def test_crashed_workers_shard_is_reclaimed(self):
+        a = self.worker('a', lease_seconds=0.2)
+        b = self.worker('b', lease_seconds=0.2)
+        self.assertEqual(a.claim(), 0)
+        # a crashes without finishing shard 0
+        self.assertEqual(b.claim(), 1)
+        b.finish()
+        self.assertEqual(b.claim(), None)
+        self.assertNotEqual(b.next_expiry(), None)
+        time.sleep(0.3)
+        self.assertEqual(b.claim(), 0)
+        b.finish()
+        self.assertEqual(b.next_expiry(), None)
+
+    def test_finished_run_starts_new_generation(self):
+        a = self.worker('a')
+        for shard in (0, 1):
+            self.assertEqual(a.claim(), shard)
+            a.finish()
+        again = self.worker('a')
+        self.assertEqual(again.generation, a.generation + 1)
+        self.assertEqual(again.claim(), 0)
+
+    def test_late_worker_joins_unfinished_generation(self):
+        a = self.worker('a')
+        self.assertEqual(a.claim(), 0)
+        b = self.worker('b')
+        self.assertEqual(b.generation, a.generation)
+        self.assertEqual(b.claim(), 1)
+
+    def test_heartbeat_after_takeover_raises(self):
+        a = self.worker('a', lease_seconds=0.1)
+        b = self.worker('b', lease_seconds=0.1)
+        a.claim()
+        time.sleep(0.2)
+        self.assertEqual(b.claim(), 0)
+        self.assertRaises(coordination.LeaseLost, a.heartbeat, True)
+
+
+if __name__ == '__main__':
+    unittest.main()
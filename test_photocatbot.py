@@ -0,0 +1,195 @@
+import argparse
+import io
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+os.environ.setdefault('PYWIKIBOT_NO_USER_CONFIG', '2')
+
+import PhotoCatBot
+import coordination
+
+
+def stub_resolver(site, template):
+    """Resolve template names without the wiki: no redirects."""
+    name = unicode(template.name).strip()
+    return u'Template:' + name[:1].upper() + name[1:]
+
+
+def make_bot(text):
+    bot = PhotoCatBot.PhotoCatBot(generator=[], resolver=stub_resolver)
+    bot._article = bot._talk = None
+    bot._article_text = None
+    bot._article_talk = text
+    return bot
+
+
+class NeedsUpdateTest(unittest.TestCase):
+
+    def test_header_request_parses_header_only(self):
+        bot = make_bot(u'{{WikiProject Ships}}\n{{image requested}}\n'
+                       u'== Photo ==\nSome discussion.\n')
+        self.assertTrue(bot.needs_update())
+        self.assertEqual(bot._talk_tail, u'== Photo ==\nSome discussion.\n')
+        self.assertEqual(bot.fix_photo_request(),
+                         u'{{WikiProject Ships}}\n{{image requested|ships}}\n'
+                         u'== Photo ==\nSome discussion.\n')
+
+    def test_bare_request_below_filled_header_request(self):
+        bot = make_bot(u'{{image requested|in=Ohio}}\n'
+                       u'== Photo ==\n{{image requested}}\n')
+        self.assertTrue(bot.needs_update())
+        self.assertEqual(bot._talk_tail, u'')
+
+    def test_banners_below_first_heading(self):
+        bot = make_bot(u'{{image requested}}\n== Old ==\n'
+                       u'{{WikiProject Ships}}\n{{WikiProject Birds}}\n')
+        self.assertTrue(bot.needs_update())
+        self.assertEqual(bot._talk_tail, u'')
+        self.assertEqual(bot.fix_photo_request(),
+                         u'{{image requested|ships}}\n== Old ==\n'
+                         u'{{WikiProject Ships}}\n'
+                         u'{{WikiProject Birds|needs-photo=yes}}\n')
+
+    def test_filled_request(self):
+        bot = make_bot(u'{{image requested|in=Ohio}}\n== Photo ==\nfoo\n')
+        self.assertFalse(bot.needs_update())
+
+    def test_request_below_first_heading(self):
+        bot = make_bot(u'{{WikiProject Ships}}\n== Photo ==\n{{image requested}}\n')
+        self.assertTrue(bot.needs_update())
+        self.assertEqual(bot.fix_photo_request(),
+                         u'{{WikiProject Ships}}\n== Photo ==\n'
+                         u'{{image requested|ships}}\n')
+
+
+class SplitHeaderTest(unittest.TestCase):
+
+    def test_splits_at_first_heading(self):
+        self.assertEqual(PhotoCatBot.split_header(u'{{a}}\n== b ==\nc\n'),
+                         (u'{{a}}\n', u'== b ==\nc\n'))
+
+    def test_closed_blocks_allow_split(self):
+        text = (u'x<ref name="a"/><ref>y</ref>\n{|\n| z\n|}\n'
+                u'== b ==\n')
+        self.assertEqual(PhotoCatBot.split_header(text)[1], u'== b ==\n')
+
+    def test_no_split_inside_open_blocks(self):
+        for opener in (u'{{a|\n', u'<!--\n', u'<nowiki>\n', u'<pre>\n',
+                       u'x<ref>\n', u'<source lang="python">\n',
+                       u'<syntaxhighlight>\n', u'<math>\n', u'{|\n| a\n'):
+            self.assertEqual(PhotoCatBot.split_header(opener + u'== b ==\n'),
+                             None, opener)
+
+
+class CensusTest(unittest.TestCase):
+
+    def test_treat_text(self):
+        out = io.BytesIO()
+        census = PhotoCatBot.PhotoCensus(out, generator=[],
+                                         resolver=stub_resolver)
+        census.treat_text(u'Talk:Example',
+                          u'{{WikiProject Ships}}\n{{WikiProject Ohio}}\n'
+                          u'{{WikiProject Birds}}\n{{image requested}}\n')
+        census.treat_text(u'Talk:Other', u'{{WikiProject Ships}}\n')
+
+        self.assertEqual(out.getvalue().splitlines(), [
+            'page,has_request,needs_update,subjects,locations,banners',
+            'Talk:Example,1,1,ships,Ohio,WikiProject Birds',
+            'Talk:Other,0,0,ships,,',
+            ])
+        self.assertEqual(census.counts['total']['pages'], 2)
+        self.assertEqual(census.counts['total']['needs_update'], 1)
+        self.assertEqual(census.counts['subject']['ships'], 2)
+        self.assertEqual(census.counts['location']['Ohio'], 1)
+        self.assertEqual(census.counts['banner']['WikiProject Birds'], 1)
+
+
+class RemoveStaleSocketTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'photocatbot.sock')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def bind(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.path)
+        return sock
+
+    def test_stale_socket_is_removed(self):
+        self.bind().close()
+        PhotoCatBot.remove_stale_socket(self.path)
+        self.assertFalse(os.path.lexists(self.path))
+
+    def test_live_socket_is_kept(self):
+        sock = self.bind()
+        sock.listen(1)
+        try:
+            self.assertRaises(SystemExit,
+                              PhotoCatBot.remove_stale_socket, self.path)
+            self.assertTrue(os.path.lexists(self.path))
+        finally:
+            sock.close()
+
+    def test_regular_file_is_kept(self):
+        open(self.path, 'w').close()
+        self.assertRaises(SystemExit,
+                          PhotoCatBot.remove_stale_socket, self.path)
+        self.assertTrue(os.path.exists(self.path))
+
+
+class StubBot(object):
+    """Stands in for PhotoCatBot: run() treats nothing and reports
+    whether it got to the end of its generator, as pywikibot does."""
+
+    completed = True
+
+    def __init__(self, generator, **kwargs):
+        self._generator_completed = False
+
+    def run(self):
+        self._generator_completed = self.completed
+
+
+class RunShardedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.args = argparse.Namespace(
+            run='test', category='Test', shards=2, edits_per_minute=10,
+            coord=os.path.join(self.tmpdir, 'coord.db'),
+            pages=[], debug=False, always=True)
+        self.real_bot = PhotoCatBot.PhotoCatBot
+        PhotoCatBot.PhotoCatBot = StubBot
+
+    def tearDown(self):
+        PhotoCatBot.PhotoCatBot = self.real_bot
+        StubBot.completed = True
+        shutil.rmtree(self.tmpdir)
+
+    def other_worker(self):
+        return coordination.Coordinator(self.args.coord, 2, 'test',
+                                        worker='other')
+
+    def test_completed_run_finishes_every_shard(self):
+        self.assertTrue(PhotoCatBot.run_sharded(self.args, lambda: []))
+        self.assertEqual(self.other_worker().next_expiry(), None)
+
+    def test_stopped_run_leaves_shard_unfinished(self):
+        StubBot.completed = False
+        self.assertFalse(PhotoCatBot.run_sharded(self.args, lambda: []))
+        other = self.other_worker()
+        # Shard 0 is still leased and not done, and shard 1 was never
+        # claimed, so the stopped worker did not move on.
+        self.assertEqual(other.generation, 0)
+        self.assertEqual(other.claim(), 1)
+        self.assertNotEqual(other.next_expiry(), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,286 @@
+import os
+import sys
+import types
+import unittest
+
+os.environ.setdefault('PYWIKIBOT_NO_USER_CONFIG', '2')
+
+try:
+    import county_map
+except ImportError:
+    # county_map is looked up over the network and kept out of the
+    # repository; every test below uses StubCountyMap instead.
+    sys.modules['county_map'] = types.ModuleType('county_map')
+
+import PhotoCountyBot
+import ratecontrol
+
+
+class StubCountyMap(object):
+    """Stands in for county_map.county_map, counting its instances."""
+
+    counties = {'Springfield, Ohio': 'Clark County, Ohio'}
+    instances = 0
+
+    def __init__(self):
+        StubCountyMap.instances += 1
+        self.looked_up = []
+
+    def lookup(self, link):
+        self.looked_up.append(link)
+        return self.counties.get(link)
+
+
+class StubWiki(object):
+
+    def __init__(self, texts):
+        self.texts = texts
+        self.fetched = []
+
+
+class StubPage(object):
+    """A page that, like a pywikibot Page, keeps its text once fetched."""
+
+    def __init__(self, wiki, title):
+        self.wiki = wiki
+        self._title = title
+        self._text = None
+
+    def title(self):
+        return self._title
+
+    def isTalkPage(self):
+        return self._title.startswith('Talk:')
+
+    def toggleTalkPage(self):
+        if self.isTalkPage():
+            return StubPage(self.wiki, self._title[len('Talk:'):])
+        return StubPage(self.wiki, 'Talk:' + self._title)
+
+    def get(self):
+        if self._text is None:
+            self.wiki.fetched.append(self._title)
+            self._text = self.wiki.texts[self._title]
+        return self._text
+
+
+class CountingController(ratecontrol.AIMDController):
+
+    def __init__(self, **kwargs):
+        super(CountingController, self).__init__(**kwargs)
+        self.calls = []
+
+    def call(self, func, args=(), pages=1):
+        self.calls.append(func)
+        return super(CountingController, self).call(func, args, pages)
+
+
+infobox = (u'{{Infobox settlement\n'
+           u'| subdivision_name2 = [[Greene County, Ohio]]\n}}\n'
+           u'Xenia is a city.')
+linked = u'The X is in [[Springfield, Ohio|Springfield]].\n\nMore.'
+talk = u'{{WikiProject Ohio}}\n'
+
+
+class CountyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.real_county_map = PhotoCountyBot.county_map
+        PhotoCountyBot.county_map = types.ModuleType('county_map')
+        PhotoCountyBot.county_map.county_map = StubCountyMap
+        StubCountyMap.instances = 0
+        self.wiki = StubWiki({
+            u'Xenia': infobox, u'Talk:Xenia': talk,
+            u'Bridge': linked, u'Talk:Bridge': talk,
+            })
+
+    def tearDown(self):
+        PhotoCountyBot.county_map = self.real_county_map
+
+    def page(self, title):
+        return StubPage(self.wiki, title)
+
+    def preloaded(self, title):
+        """Return a page as adaptive_preload() would yield it."""
+        page = self.page(title)
+        page._text = self.wiki.texts[title]
+        return page
+
+
+class LookupsTest(CountyTestCase):
+
+    def test_infobox_is_read_from_article_text(self):
+        lookups = PhotoCountyBot.Lookups(self.page(u'Xenia'),
+                                         self.page(u'Talk:Xenia'))
+        self.assertEqual(lookups.infobox_county(), u'Greene County, Ohio')
+        self.assertEqual(lookups.infobox_county(), u'Greene County, Ohio')
+        self.assertEqual(self.wiki.fetched, [u'Xenia'])
+
+    def test_links_share_one_county_map(self):
+        lookups = PhotoCountyBot.Lookups(self.page(u'Bridge'),
+                                         self.page(u'Talk:Bridge'))
+        self.assertEqual(lookups.link_county(u'Springfield, Ohio'),
+                         u'Clark County, Ohio')
+        self.assertEqual(lookups.link_county(u'Dayton, Ohio'), None)
+        self.assertEqual(StubCountyMap.instances, 1)
+
+    def test_guess_county_uses_lookups(self):
+        lookups = PhotoCountyBot.Lookups(self.page(u'Bridge'),
+                                         self.page(u'Talk:Bridge'))
+        self.assertEqual(PhotoCountyBot.guess_county(linked, 'Ohio', lookups),
+                         u'Clark County, Ohio')
+
+
+class CountyLookupEngineTest(CountyTestCase):
+
+    def setUp(self):
+        super(CountyLookupEngineTest, self).setUp()
+        self.controller = CountingController(max_concurrency=4)
+        self.engine = PhotoCountyBot.CountyLookupEngine('Ohio', self.controller,
+                                                        window=3)
+
+    def test_prefetches_each_page_once(self):
+        pages = [self.preloaded(t) for t in
+                 (u'Talk:Xenia', u'Talk:Bridge', u'Talk:Xenia', u'Bridge')]
+        seen = []
+        for page in self.engine.prefetch(pages):
+            lookups = self.engine.take(page)
+            seen.append(page.title())
+            county = (lookups.infobox_county()
+                      or PhotoCountyBot.guess_county(lookups.article_text(),
+                                                     'Ohio', lookups))
+            lookups.talk_text()
+            self.assertEqual(county, {u'Xenia': u'Greene County, Ohio',
+                                      u'Bridge': u'Clark County, Ohio'}[
+                                          lookups.article.title()])
+        self.assertEqual(sorted(seen), sorted(p.title() for p in pages))
+        self.assertEqual(self.engine.lookups, {})
+
+        # The pages from the generator are already loaded; only the
+        # other page of each pair is fetched, once, via the controller.
+        self.assertEqual(sorted(self.wiki.fetched),
+                         [u'Bridge', u'Talk:Bridge', u'Xenia', u'Xenia'])
+        self.assertEqual(len(self.controller.calls), 4 + 2)
+        # The link is looked up for the two 'Bridge' pages only, with
+        # the engine's one county_map.
+        self.assertEqual(StubCountyMap.instances, 1)
+        self.assertEqual(self.engine.county_map.looked_up,
+                         [u'Springfield, Ohio'] * 2)
+
+    def test_missing_article_is_reported_by_treat(self):
+        self.wiki.texts[u'Talk:Gone'] = talk
+        pages = list(self.engine.prefetch([self.preloaded(u'Talk:Gone')]))
+        lookups = self.engine.take(pages[0])
+        self.assertRaises(KeyError, lookups.article_text)
+
+
+class StubCategory(object):
+
+    def __init__(self, title):
+        self._title = title
+
+    def title(self, withNamespace=True):
+        return self._title
+
+
+class StubSite(object):
+    """Answers allpages() from a fixed list of category titles."""
+
+    def __init__(self, titles):
+        self.titles = titles
+
+    def allpages(self, prefix='', namespace=0):
+        return [StubCategory(t) for t in self.titles if t.startswith(prefix)]
+
+
+class CategoryIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.created = []
+        self.fail = set()
+        self.real_create_category = PhotoCountyBot.create_category
+        PhotoCountyBot.create_category = self.create_category
+        self.index = PhotoCountyBot.CategoryIndex(StubSite([
+            u'Wikipedia requested photographs in Clark County, Ohio',
+            u'Wikipedia requested maps in Greene County, Ohio',
+            ]))
+
+    def tearDown(self):
+        PhotoCountyBot.create_category = self.real_create_category
+
+    def create_category(self, county, state):
+        if county in self.fail:
+            raise PhotoCountyBot.pywikibot.Error(county)
+        self.created.append((county, state))
+
+    def test_queues_each_missing_category_once(self):
+        for county in (u'Clark County, Ohio', u'Greene County, Ohio',
+                       u'Greene County, Ohio', u'Lake County, Ohio'):
+            self.index.request(county, 'Ohio')
+        self.assertEqual(sorted(self.index.pending),
+                         [u'Greene County, Ohio', u'Lake County, Ohio'])
+
+        self.index.create_pending()
+        self.assertEqual(self.created, [(u'Greene County, Ohio', 'Ohio'),
+                                        (u'Lake County, Ohio', 'Ohio')])
+        self.assertEqual(self.index.pending, {})
+
+        # Once created, a category is not queued again.
+        self.index.request(u'Lake County, Ohio', 'Ohio')
+        self.assertEqual(self.index.pending, {})
+
+    def test_failed_creation_is_retried_later(self):
+        self.fail.add(u'Lake County, Ohio')
+        self.index.request(u'Lake County, Ohio', 'Ohio')
+        self.index.request(u'Greene County, Ohio', 'Ohio')
+        self.index.create_pending()
+        self.assertEqual(self.created, [(u'Greene County, Ohio', 'Ohio')])
+
+        self.fail.clear()
+        self.index.request(u'Lake County, Ohio', 'Ohio')
+        self.index.create_pending()
+        self.assertEqual(self.created[-1], (u'Lake County, Ohio', 'Ohio'))
+
+
+class CreateCategoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = []
+        self.exists = False
+        pywikibot = PhotoCountyBot.pywikibot
+        self.real = pywikibot.Site, pywikibot.Page
+        test = self
+
+        class StubCategoryPage(object):
+            def __init__(self, site, title):
+                self.site = site
+                self._title = title
+
+            def title(self, as_link=False):
+                return self._title
+
+            def put(self, text, **kwargs):
+                if test.exists and kwargs.get('createonly'):
+                    raise pywikibot.PageCreatedConflict(self)
+                test.saved.append((self._title, kwargs))
+
+        pywikibot.Site = lambda: None
+        pywikibot.Page = StubCategoryPage
+
+    def tearDown(self):
+        PhotoCountyBot.pywikibot.Site, PhotoCountyBot.pywikibot.Page = self.real
+
+    def test_creates_only(self):
+        PhotoCountyBot.create_category(u'Lake County, Ohio', 'Ohio')
+        self.assertEqual(self.saved, [
+            (u'Category:Wikipedia requested photographs in Lake County, Ohio',
+             {'createonly': True})])
+
+    def test_existing_category_counts_as_created(self):
+        self.exists = True
+        PhotoCountyBot.create_category(u'Lake County, Ohio', 'Ohio')
+        self.assertEqual(self.saved, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,225 @@
+import threading
+import time
+import unittest
+
+import ratecontrol
+
+
+class FakeClock(object):
+    """A clock that only moves when something sleeps on it."""
+
+    def __init__(self):
+        self.now = 0.0
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        with self._lock:
+            self.now += seconds
+
+
+class LaggyWiki(object):
+    """Local stand-in for the wiki API.
+
+    Serving a batch takes 'per_page' seconds per page on the fake clock.
+    Between 'lag_from' and 'lag_until' the server is lagged: requests
+    are answered with a maxlag error carrying 'retry_after'.
+    """
+
+    def __init__(self, clock, per_page=0.01, lag_from=None, lag_until=None,
+                 retry_after=5):
+        self.clock = clock
+        self.per_page = per_page
+        self.lag_from = lag_from
+        self.lag_until = lag_until
+        self.retry_after = retry_after
+        self.lagged = 0
+        self.served = []    # (time, batch size) of each answered request
+
+    def is_lagged(self):
+        return (self.lag_from is not None
+                and self.lag_from <= self.clock() < self.lag_until)
+
+    def fetch(self, pages):
+        if self.is_lagged():
+            self.lagged += 1
+            raise ratecontrol.Lagged(self.retry_after)
+        self.served.append((self.clock(), len(pages)))
+        self.clock.sleep(self.per_page * len(pages))
+        return pages
+
+
+class FakeThrottle(object):
+
+    def __init__(self):
+        self.retry_after = 0
+        self.lags = []
+
+    def lag(self, lagtime=None):
+        self.lags.append(lagtime)
+
+
+class AIMDControllerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.controller = ratecontrol.AIMDController(clock=self.clock,
+                                                     sleep=self.clock.sleep)
+
+    def test_grows_while_healthy(self):
+        for _ in range(200):
+            self.controller.on_response(0.1, self.controller.batch_size)
+        self.assertEqual(self.controller.concurrency,
+                         self.controller.max_concurrency)
+        self.assertEqual(self.controller.batch_size, self.controller.max_batch)
+
+    def test_slow_responses_back_off(self):
+        for _ in range(200):
+            self.controller.on_response(0.1, self.controller.batch_size)
+        self.controller.on_response(100, self.controller.min_batch)
+        self.assertEqual(self.controller.concurrency,
+                         self.controller.max_concurrency // 2)
+        self.assertEqual(self.controller.batch_size,
+                         self.controller.max_batch // 2)
+
+    def test_lag_holds_readers(self):
+        self.controller.on_lag(7)
+        self.controller.wait()
+        self.assertEqual(self.clock(), 7)
+        self.controller.wait()
+        self.assertEqual(self.clock(), 7)
+
+    def test_lag_without_retry_after_uses_default(self):
+        self.controller.on_lag()
+        self.controller.wait()
+        self.assertEqual(self.clock(), self.controller.default_retry_after)
+
+    def test_call_records_lag(self):
+        wiki = LaggyWiki(self.clock, lag_from=0, lag_until=5, retry_after=5)
+        self.assertRaises(ratecontrol.Lagged,
+                          self.controller.call, wiki.fetch, ([1, 2],), 2)
+        self.assertEqual(self.controller.call(wiki.fetch, ([1, 2],), 2),
+                         [1, 2])
+        self.assertEqual(wiki.served, [(5, 2)])
+
+    def test_call_limits_concurrency(self):
+        controller = ratecontrol.AIMDController(min_concurrency=2,
+                                                max_concurrency=2)
+        lock = threading.Lock()
+        release = threading.Event()
+        running = [0, 0]    # now, most at once
+
+        def fetch():
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            release.wait(1)
+            with lock:
+                running[0] -= 1
+
+        threads = [threading.Thread(target=controller.call, args=(fetch,))
+                   for _ in range(5)]
+        for t in threads:
+            t.start()
+        time.sleep(0.1)
+        release.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(running, [0, 2])
+
+
+class AdaptivePreloadTest(unittest.TestCase):
+
+    def test_backs_off_under_lag_and_recovers(self):
+        clock = FakeClock()
+        controller = ratecontrol.AIMDController(clock=clock, sleep=clock.sleep)
+        wiki = LaggyWiki(clock, lag_from=5, lag_until=20)
+
+        pages = list(range(20000))
+        seen = list(ratecontrol.adaptive_preload(pages, controller, wiki.fetch))
+
+        self.assertEqual(seen, pages)
+        self.assertTrue(wiki.lagged > 0)
+        before = [size for t, size in wiki.served if t < 5]
+        after = [size for t, size in wiki.served if t >= 20]
+        # Batches already formed when the lag hit keep their size;
+        # the next ones are cut back.
+        self.assertTrue(min(after[:10]) < max(before))
+        self.assertEqual(max(after), controller.max_batch)
+
+    def test_gives_up_when_lag_persists(self):
+        clock = FakeClock()
+        controller = ratecontrol.AIMDController(clock=clock, sleep=clock.sleep)
+        wiki = LaggyWiki(clock, lag_from=0, lag_until=float('inf'))
+
+        preload = ratecontrol.adaptive_preload(range(100), controller,
+                                               wiki.fetch, max_retries=3)
+        self.assertRaises(ratecontrol.Lagged, list, preload)
+        self.assertEqual(wiki.lagged, 4)
+
+    def test_fetches_ahead_while_pages_are_used(self):
+        controller = ratecontrol.AIMDController()
+        fetched = []
+        second_batch = threading.Event()
+
+        def fetch(batch):
+            fetched.append(batch)
+            if len(fetched) == 2:
+                second_batch.set()
+            return batch
+
+        pages = ratecontrol.adaptive_preload(range(100), controller, fetch)
+        self.assertEqual(next(pages), 0)
+        # The first batch is still being used, and the next is on its way.
+        second_batch.wait(1)
+        self.assertTrue(second_batch.is_set())
+        self.assertEqual(list(pages), list(range(1, 100)))
+
+    def test_shares_slots_with_other_callers(self):
+        controller = ratecontrol.AIMDController(min_concurrency=2,
+                                                max_concurrency=2)
+        lock = threading.Lock()
+        running = [0, 0]    # now, most at once
+
+        def fetch(batch=None):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+            return batch
+
+        other = threading.Thread(
+            target=lambda: [controller.call(fetch) for _ in range(10)])
+        other.start()
+        pages = list(ratecontrol.adaptive_preload(range(100), controller,
+                                                  fetch))
+        other.join()
+        self.assertEqual(pages, list(range(100)))
+        self.assertTrue(running[1] <= 2)
+
+    def test_watch_lag_reports_to_controller(self):
+        clock = FakeClock()
+        controller = ratecontrol.AIMDController(clock=clock, sleep=clock.sleep)
+        throttle = FakeThrottle()
+        ratecontrol.watch_lag(throttle, controller)
+        ratecontrol.watch_lag(throttle, controller)
+
+        throttle.retry_after = 12
+        throttle.lag(3)
+        self.assertEqual(throttle.lags, [3])
+        controller.wait()
+        self.assertEqual(clock(), 12)
+
+        throttle.retry_after = 0
+        throttle.lag(3)
+        self.assertEqual(throttle.lags, [3, 3])
+        controller.wait()
+        self.assertEqual(clock(), 15)
+
+
+if __name__ == '__main__':
+    unittest.main()